@@ -2,34 +2,94 @@ import os
 import re
 import time
 import hashlib
-import json
+import html
+import secrets
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import sqlite3
+import sys
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, timezone
-import requests
+import httpx
+import orjson
 import asyncio
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Логи пишутся в очередь, а в stderr их выводит фоновый поток — event loop не ждёт вывода
+logger = logging.getLogger("ggsel_bot")
+_LOG_LISTENER: QueueListener | None = None
+
 # — Конфигурация только из .env
 BOT_TOKEN = os.getenv("TG_BOT_TOKEN")
 
 # API key используется для получения временного session token через /apilogin
 API_KEY = os.getenv("GGSEL_API_KEY")
+_API_KEY_BYTES = (API_KEY or "").encode("utf-8")
 
 # Идентификатор продавца для эндпоинтов продаж
 SELLER_ID = os.getenv("SELLER_ID")
 
+# Необязательно: публичный HTTPS-адрес бота. Если задан, Telegram присылает апдейты вебхуком
+# вместо long polling (нужен python-telegram-bot[webhooks])
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN") or "0.0.0.0"
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 8443)
+# Секрет, который Telegram шлёт в X-Telegram-Bot-Api-Secret-Token; без него апдейты отвергаются.
+# Если не задан — генерируем при каждом запуске (run_webhook заново регистрирует вебхук)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
 # Динамический токен, выдаваемый /apilogin
 API_TOKEN: str | None = None
-API_TOKEN_EXPIRES_AT: float = 0.0
+# Срок жизни токена по монотонным часам: не зависит от скачков системного времени (NTP)
+_TOKEN_DEADLINE_MONO: float = 0.0
+_TOKEN_LOCK = asyncio.Lock()
+
+# Файл состояния: уже показанные заказы переживают перезапуск бота
+STATE_DB = os.getenv("GGSEL_STATE_DB") or os.path.expanduser("~/.ggsel_bot_state.db")
+_STATE_DB: sqlite3.Connection | None = None
+# Записи в базу идут из потоков по одной
+_STATE_LOCK = asyncio.Lock()
+
+# Сколько ключей уже показанных сообщений/заказов помнить на один чат
+SEEN_KEYS_MAX = 2000
+
+# Кэш /purchase/info: invoice_id -> (expires_at по time.monotonic(), content).
+# Оплаченный заказ уже не меняется — храним бессрочно, неоплаченный перепроверяем через минуту.
+PURCHASE_CACHE_MAX = 256
+PURCHASE_CACHE_UNPAID_TTL = 60
+_PURCHASE_CACHE: "OrderedDict[int, tuple[float, dict]]" = OrderedDict()
+
+# Курсор по непрочитанным диалогам: id_i -> (etag, id самого нового сообщения, последняя реплика покупателя).
+# etag — пара (last_message, cnt_new) из /chats: пока она та же, сообщения диалога не перезапрашиваем.
+# id передаём как newer=, чтобы сервер отдавал только новые сообщения.
+_CHAT_CURSORS: dict[int, tuple[tuple, int | None, dict | None]] = {}
+
+# Условные запросы: (url, параметры без токена) -> (ETag, Last-Modified, разобранный ответ)
+_ETAG_CACHE: dict[tuple, tuple[str | None, str | None, dict | list]] = {}
+
+# Последний полный ответ last-sales: если верхняя продажа не сменилась, список тот же
+_SALES_SNAPSHOT: dict = {"top": None, "top_invoice": None, "sales": []}
+
+# Короткий кэш результатов проверок: ручная кнопка сразу после авто-опроса не ходит в API заново.
+# key -> (monotonic-время получения, результат); отдельный замок на ключ — один запрос в полёте
+UNREAD_CACHE_TTL = 15
+ORDERS_CACHE_TTL = 30
+_RESULT_CACHE: dict[str, tuple[float, object]] = {}
+_RESULT_LOCKS: dict[str, asyncio.Lock] = {}
 
 # Заголовки для API-запросов (некоторые эндпоинты отдают HTML без этих заголовков)
 HEADERS = {
     "Accept": "application/json, text/plain, */*",
     "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
+    "Accept-Encoding": "gzip, deflate",
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "X-Requested-With": "XMLHttpRequest",
     "Referer": "https://seller.ggsel.net/",
@@ -37,7 +97,29 @@ HEADERS = {
 }
 
 # Для некоторых эндпоинтов требуется заголовок locale
-HEADERS_LOCALE_RU = {**HEADERS, "locale": "ru"}
+HEADERS_LOCALE_RU = {"locale": "ru"}
+
+# Тело apilogin сериализуем сами через orjson
+HEADERS_JSON_BODY = {"Content-Type": "application/json"}
+
+# Общий асинхронный HTTP-клиент: keep-alive пул соединений, запросы не блокируют event loop бота.
+# Создаётся при старте приложения (post_init) внутри его event loop и закрывается в post_shutdown.
+CLIENT: httpx.AsyncClient | None = None
+
+
+def _create_http_client() -> httpx.AsyncClient:
+    # HTTP/2 мультиплексирует параллельные запросы по диалогам/заказам в одном TLS-соединении.
+    # http2 и limits задаём на транспорте: при явном transport= клиент свои http2/limits игнорирует.
+    return httpx.AsyncClient(
+        headers=HEADERS,
+        timeout=httpx.Timeout(30.0),
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            retries=2,
+        ),
+        follow_redirects=True,
+    )
 
 # Базовые URL официального API
 BASE_API = "https://seller.ggsel.net"
@@ -52,11 +134,33 @@ BUTTON_TEXT = "💬 Проверить сообщения"
 BUTTON_TEXT_ORDERS = "🧾 Проверить заказы"
 BUTTON_TEXT_DEBUG = "🔍 Диагностика API"
 
+# Telegram режет сообщения длиннее 4096 символов — оставляем запас
+TG_MESSAGE_LIMIT = 4000
+# Предел для текста покупателя в уведомлении (после экранирования); шаблон и остальные поля укладываются в остаток
+ALERT_TEXT_LIMIT = 3000
+
+# Не больше 20 одновременных отправок в Telegram на всю рассылку (глобальный лимит ~30 сообщений/с)
+TG_SEND_CONCURRENCY = 20
+_SEND_SEMAPHORE = asyncio.Semaphore(TG_SEND_CONCURRENCY)
+
+# Дебаунс авто-уведомлений: пачка закрывается после паузы DISPATCH_GAP секунд,
+# через DISPATCH_WINDOW секунд от первого уведомления или на DISPATCH_MAX_ITEMS штуках
+DISPATCH_GAP = 0.3
+DISPATCH_WINDOW = 1.0
+DISPATCH_MAX_ITEMS = 50
+
+# Паттерн компилируем один раз при импорте
+_TOKEN_RE = re.compile(r"(token=)[^&]+")
+
+# Имя общего задания JobQueue: опрос сообщений и заказов за один проход
+GLOBAL_POLL_JOB = "global_poll"
+
 # === Клиент официального API ===
-def _json_or_error(resp: requests.Response):
+def _json_or_error(resp: httpx.Response):
+    # orjson разбирает байты тела напрямую, без промежуточного декодирования в str
     try:
-        return resp.json()
-    except ValueError:
+        return orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
         content_type = resp.headers.get("Content-Type", "")
         snippet = (resp.text or "")[:300].replace("\n", " ")
         raise RuntimeError(
@@ -65,34 +169,49 @@ def _json_or_error(resp: requests.Response):
 
 
 def _auth_headers(locale_ru: bool = False, with_bearer: bool = True) -> dict:
-    # Отдаём и стандартные заголовки, и Bearer как запасной вариант авторизации
-    headers = dict(HEADERS_LOCALE_RU if locale_ru else HEADERS)
-    if with_bearer and API_TOKEN:
-        headers.setdefault("Authorization", f"Bearer {API_TOKEN}")
-    return headers
+    # Статические заголовки уже лежат в CLIENT.headers — отдаём только добавки:
+    # locale и Bearer как запасной вариант авторизации
+    headers = {"Authorization": f"Bearer {API_TOKEN}"} if with_bearer and API_TOKEN else {}
+    return headers | HEADERS_LOCALE_RU if locale_ru else headers
+
 
+def _sha256_hex(ts: str) -> str:
+    # Подпись apilogin: sha256(API_KEY + timestamp); байты ключа закодированы заранее
+    return hashlib.sha256(_API_KEY_BYTES + ts.encode("ascii"), usedforsecurity=False).hexdigest()
 
-def _sha256_hex(s: str) -> str:
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
+def _token_is_fresh(force_refresh: bool, stale_token: str | None) -> bool:
+    if not API_TOKEN or time.monotonic() >= _TOKEN_DEADLINE_MONO - 30:
+        return False
+    # При force_refresh токен годится, только если его уже обновил кто-то другой
+    return not force_refresh or (stale_token is not None and API_TOKEN != stale_token)
 
-def _ensure_api_token(force_refresh: bool = False):
-    global API_TOKEN, API_TOKEN_EXPIRES_AT
+
+async def _ensure_api_token(force_refresh: bool = False, stale_token: str | None = None):
     if not SELLER_ID or not str(SELLER_ID).strip():
         raise RuntimeError("Не задан SELLER_ID")
     if not API_KEY:
         raise RuntimeError("Не задан API ключ (GGSEL_API_KEY)")
-    now = time.time()
-    if API_TOKEN and not force_refresh and API_TOKEN_EXPIRES_AT - now > 30:
+    if _token_is_fresh(force_refresh, stale_token):
         return
+    # Один apilogin на всех: остальные корутины ждут замок и видят уже новый токен
+    async with _TOKEN_LOCK:
+        if _token_is_fresh(force_refresh, stale_token):
+            return
+        await _api_login()
+
+
+async def _api_login():
+    global API_TOKEN, _TOKEN_DEADLINE_MONO
+    now = time.time()
     ts = str(int(now))
-    sign = _sha256_hex(f"{API_KEY}{ts}")
+    sign = _sha256_hex(ts)
     payload = {"seller_id": int(SELLER_ID), "timestamp": ts, "sign": sign}
-    headers = _auth_headers(locale_ru=True, with_bearer=False)
-    r = requests.post(API_LOGIN_URL, json=payload, headers=headers, timeout=60)
+    headers = _auth_headers(locale_ru=True, with_bearer=False) | HEADERS_JSON_BODY
+    r = await CLIENT.post(API_LOGIN_URL, content=orjson.dumps(payload), headers=headers, timeout=60)
     if r.status_code != 200:
         raise RuntimeError(f"apilogin HTTP {r.status_code}: {(r.text or '')[:160]}")
-    data = r.json() if r.headers.get("Content-Type", "").startswith("application/json") else {}
+    data = orjson.loads(r.content) if r.headers.get("Content-Type", "").startswith("application/json") else {}
     token = (data or {}).get("token")
     if not token:
         desc = (data or {}).get("desc") or (data or {}).get("retdesc") or "—"
@@ -101,40 +220,57 @@ def _ensure_api_token(force_refresh: bool = False):
     # истечение срока
     valid_thru = (data or {}).get("valid_thru")
     expires_at = now + 1800
-    if isinstance(valid_thru, str):
-        try:
-            dt = datetime.fromisoformat(valid_thru.replace("Z", "+00:00"))
-            expires_at = dt.timestamp()
-        except Exception:
-            pass
-    API_TOKEN_EXPIRES_AT = expires_at
+    if isinstance(valid_thru, str) and _to_ts(valid_thru) != float("-inf"):
+        expires_at = _to_ts(valid_thru)
+    # valid_thru задан по настенным часам — переводим в остаток и дальше считаем по monotonic.
+    # Минимум 60 с, чтобы при расхождении часов токен не считался протухшим сразу после выдачи
+    remaining = max(60.0, expires_at - time.time())
+    _TOKEN_DEADLINE_MONO = time.monotonic() + remaining
 
 
-def _request_json(url: str, params: dict | None = None, locale_ru: bool = False, timeout: int = 60, _retry: bool = True) -> dict | list:
+async def _request_json(url: str, params: dict | None = None, locale_ru: bool = False, timeout: int = 60, _retry: bool = True, conditional: bool = False) -> dict | list:
+    """GET с авторизацией; token в params подставляем сами, вызывающим его передавать не нужно.
+    conditional=True: шлём If-None-Match / If-Modified-Since по валидаторам прошлого ответа
+    и на 304 отдаём его же без разбора тела."""
     params = dict(params or {})
-    _ensure_api_token()
+    await _ensure_api_token()
     headers = _auth_headers(locale_ru=locale_ru)
-    if API_TOKEN and "token" not in params:
-        params["token"] = API_TOKEN
-    resp = requests.get(url, params=params, headers=headers, timeout=timeout)
+    used_token = API_TOKEN
+    if used_token:
+        params["token"] = used_token
+    cache_key = (url, tuple(sorted((k, str(v)) for k, v in params.items() if k != "token")))
+    cached = _ETAG_CACHE.get(cache_key) if conditional else None
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    resp = await CLIENT.get(url, params=params, headers=headers, timeout=timeout)
     if resp.status_code == 401:
-        redacted_url = re.sub(r"(token=)[^&]+", r"\1***", resp.url or url)
+        redacted_url = _TOKEN_RE.sub(r"\1***", str(resp.url) or url)
         if _retry:
-            _ensure_api_token(force_refresh=True)
-            return _request_json(url, params, locale_ru, timeout, _retry=False)
+            await _ensure_api_token(force_refresh=True, stale_token=used_token)
+            return await _request_json(url, params, locale_ru, timeout, _retry=False, conditional=conditional)
         raise RuntimeError(
             f"GGSEL API 401 Unauthorized: {redacted_url}. Проверьте SELLER_ID и API ключ."
         )
+    if resp.status_code == 304 and cached is not None:
+        return cached[2]
     resp.raise_for_status()
-    return _json_or_error(resp)
+    data = _json_or_error(resp)
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    if conditional and (etag or last_modified):
+        _ETAG_CACHE[cache_key] = (etag, last_modified, data)
+    return data
 
 
  
-def api_list_chats(filter_new: int | None = None, page: int = 1, pagesize: int = 20, email: str | None = None):
+async def api_list_chats(filter_new: int | None = None, page: int = 1, pagesize: int = 20, email: str | None = None):
     if not API_KEY:
         raise RuntimeError("Не задан API ключ (GGSEL_API_KEY)")
     params = {
-        "token": API_TOKEN or "",
         "page": page,
         "pagesize": pagesize,
     }
@@ -142,116 +278,293 @@ def api_list_chats(filter_new: int | None = None, page: int = 1, pagesize: int =
         params["filter_new"] = filter_new
     if email:
         params["email"] = email
-    data = _request_json(DEBATES_CHATS_URL, params=params, locale_ru=False, timeout=25) or {}
+    data = await _request_json(DEBATES_CHATS_URL, params=params, locale_ru=False, timeout=25, conditional=True) or {}
     items = data.get("items") if isinstance(data, dict) else None
     return items or []
 
 
-def api_list_messages(conversation_id: int, count: int = 50, newer: int | None = None):
+async def api_list_messages(conversation_id: int, count: int = 50, newer: int | None = None):
     if not API_KEY:
         raise RuntimeError("Не задан API ключ (GGSEL_API_KEY)")
     params = {
-        "token": API_TOKEN or "",
         "id_i": conversation_id,
         "count": min(max(count, 1), 100),
     }
     if newer is not None:
         params["newer"] = newer
-    data = _request_json(DEBATES_URL, params=params, locale_ru=False, timeout=25)
+    data = await _request_json(DEBATES_URL, params=params, locale_ru=False, timeout=25)
     return data if isinstance(data, list) else []
 
-def api_last_sales(top: int = 4):
+async def api_last_sales(top: int = 4):
     if not API_KEY:
         raise RuntimeError("Не задан API ключ (GGSEL_API_KEY)")
     effective_seller_id = SELLER_ID
     if not effective_seller_id:
         raise RuntimeError("Не задан SELLER_ID")
+    top = max(1, min(int(top), 100))
     params = {
-        "token": API_TOKEN or "",
         "seller_id": int(effective_seller_id),
-        "top": max(1, min(int(top), 100)),
+        "top": top,
     }
-    data = _request_json(LAST_SALES_URL, params=params, locale_ru=True, timeout=60) or {}
-    return data.get("sales", [])
+    # Дешёвая проверка top=1: новые продажи появляются сверху, так что при той же
+    # верхней продаже список не изменился и полный запрос не нужен
+    if top > 1 and _SALES_SNAPSHOT["top"] == top and _SALES_SNAPSHOT["sales"]:
+        head = await _request_json(LAST_SALES_URL, params={**params, "top": 1}, locale_ru=True, timeout=60, conditional=True) or {}
+        head_sales = head.get("sales") or []
+        if head_sales and head_sales[0].get("invoice_id") == _SALES_SNAPSHOT["top_invoice"]:
+            return _SALES_SNAPSHOT["sales"]
+    data = await _request_json(LAST_SALES_URL, params=params, locale_ru=True, timeout=60, conditional=True) or {}
+    sales = data.get("sales", [])
+    _SALES_SNAPSHOT.update(top=top, top_invoice=sales[0].get("invoice_id") if sales else None, sales=sales)
+    return sales
 
 
-def api_purchase_info(invoice_id: int):
+async def api_purchase_info(invoice_id: int):
     if not API_KEY:
         raise RuntimeError("Не задан API ключ (GGSEL_API_KEY)")
+    # monotonic: перевод системных часов не продлевает и не обнуляет TTL неоплаченных счетов
+    now = time.monotonic()
+    cached = _PURCHASE_CACHE.get(invoice_id)
+    if cached is not None and cached[0] > now:
+        _PURCHASE_CACHE.move_to_end(invoice_id)
+        return cached[1]
     url = f"{PURCHASE_INFO_URL}/{invoice_id}"
-    params = {"token": API_TOKEN or ""}
-    data = _request_json(url, params=params, locale_ru=True, timeout=60) or {}
-    return data.get("content") or {}
+    data = await _request_json(url, locale_ru=True, timeout=60) or {}
+    content = data.get("content") or {}
+    expires_at = float("inf") if content.get("date_pay") else now + PURCHASE_CACHE_UNPAID_TTL
+    _PURCHASE_CACHE[invoice_id] = (expires_at, content)
+    _PURCHASE_CACHE.move_to_end(invoice_id)
+    while len(_PURCHASE_CACHE) > PURCHASE_CACHE_MAX:
+        _PURCHASE_CACHE.popitem(last=False)
+    return content
+
+
+# === Состояние между перезапусками ===
+class _LRUSet:
+    """Множество ограниченного размера с LRU-вытеснением: ключи, которые всё ещё встречаются
+    в опросах, остаются, а при переполнении уходят давно не виденные."""
+
+    def __init__(self, items=(), maxlen: int = SEEN_KEYS_MAX):
+        self.maxlen = maxlen
+        self._items: OrderedDict = OrderedDict()
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item) -> bool:
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, item) -> bool:
+        """Отмечает ключ как свежий; возвращает True, если его раньше не было."""
+        if item in self._items:
+            self._items.move_to_end(item)
+            return False
+        self._items[item] = None
+        if len(self._items) > self.maxlen:
+            self._items.popitem(last=False)
+        return True
+
+
+# Виды дедупликации: kind в таблице seen -> ключ словаря в bot_data
+SEEN_KINDS = {"keys": "seen_keys", "orders": "seen_orders"}
+
+
+def _open_state_db() -> sqlite3.Connection:
+    # check_same_thread=False: запись идёт из asyncio.to_thread, по очереди под _STATE_LOCK
+    conn = sqlite3.connect(STATE_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS seen ("
+        "chat_id INTEGER, kind TEXT, key TEXT, seen_at REAL, "
+        "PRIMARY KEY (chat_id, kind, key)) WITHOUT ROWID"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS subscribers (chat_id INTEGER PRIMARY KEY)")
+    # В памяти держим только SEEN_KEYS_MAX последних ключей на чат — хвост в базе не нужен
+    with conn:
+        conn.execute(
+            "DELETE FROM seen WHERE (chat_id, kind, key) IN ("
+            "SELECT chat_id, kind, key FROM ("
+            "SELECT chat_id, kind, key, ROW_NUMBER() OVER "
+            "(PARTITION BY chat_id, kind ORDER BY seen_at DESC) AS rn FROM seen"
+            ") WHERE rn > ?)",
+            (SEEN_KEYS_MAX,),
+        )
+    return conn
+
+
+def _decode_seen_key(raw: str):
+    key = orjson.loads(raw)
+    return tuple(key) if isinstance(key, list) else key
+
+
+def _load_state() -> dict:
+    global _STATE_DB
+    try:
+        _STATE_DB = _open_state_db()
+        rows = _STATE_DB.execute("SELECT chat_id, kind, key FROM seen ORDER BY seen_at").fetchall()
+        subscribers = {chat_id for (chat_id,) in _STATE_DB.execute("SELECT chat_id FROM subscribers")}
+    except sqlite3.Error as e:
+        logger.warning("Не удалось открыть %s: %s", STATE_DB, e)
+        return {}
+    state: dict = {field: {} for field in SEEN_KINDS.values()}
+    state["subscribers"] = subscribers
+    for chat_id, kind, key in rows:
+        field = SEEN_KINDS.get(kind)
+        if field:
+            state[field].setdefault(chat_id, _LRUSet()).add(_decode_seen_key(key))
+    return state
+
+
+def _mark_seen(app: Application, kind: str, chat_id: int, key) -> bool:
+    """Отмечает ключ просмотренным; True — ключ новый. Новые и повторно встреченные ключи
+    уходят в базу при _save_state — seen_at повторяет LRU-порядок в памяти и после рестарта."""
+    seen_set = app.bot_data.setdefault(SEEN_KINDS[kind], {}).setdefault(chat_id, _LRUSet())
+    is_new = seen_set.add(key)
+    # Словарь, а не список: между сохранениями от ключа остаётся одна запись с последним временем
+    app.bot_data.setdefault("seen_pending", {})[(chat_id, kind, orjson.dumps(key).decode())] = time.time()
+    return is_new
+
+
+def _write_state(pending: list[tuple], subscribers: list[int]):
+    if _STATE_DB is None:
+        return
+    try:
+        with _STATE_DB:
+            _STATE_DB.executemany(
+                "INSERT INTO seen VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id, kind, key) DO UPDATE SET seen_at = excluded.seen_at",
+                pending,
+            )
+            _STATE_DB.execute("DELETE FROM subscribers")
+            _STATE_DB.executemany("INSERT INTO subscribers VALUES (?)", [(chat_id,) for chat_id in subscribers])
+    except sqlite3.Error as e:
+        logger.warning("Не удалось сохранить %s: %s", STATE_DB, e)
+
+
+async def _save_state(app: Application):
+    # Новые ключи и подписчиков забираем в потоке event loop (множества меняются только здесь),
+    # а запись в sqlite уносим в поток, чтобы не блокировать бота
+    pending = [(*row, seen_at) for row, seen_at in app.bot_data.pop("seen_pending", {}).items()]
+    subscribers = sorted(app.bot_data.get("subscribers", ()))
+    async with _STATE_LOCK:
+        await asyncio.to_thread(_write_state, pending, subscribers)
+
+
+def _close_state_db():
+    global _STATE_DB
+    if _STATE_DB is not None:
+        _STATE_DB.close()
+        _STATE_DB = None
 
 
 # === Логика проверки ===
-def _select_last_unread_buyer_message(messages: list[dict]) -> dict | None:
-    if not messages:
-        return None
-    # Выбираем САМУЮ ПОСЛЕДНЮЮ реплику покупателя по дате (а не по порядку массива)
-    def _to_ts(s: str | None) -> float:
-        if not s:
-            return float("-inf")
+@lru_cache(maxsize=8192)
+def _to_ts(s: str | None) -> float:
+    # Одни и те же даты приходят из опроса в опрос — парсим каждую строку один раз.
+    # Единая точка разбора дат API: используется и для сообщений, и для valid_thru токена
+    if not s:
+        return float("-inf")
+    try:
+        return datetime.fromisoformat(s.replace("Z", "+00:00")).timestamp()
+    except Exception:
         try:
-            dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
-            return dt.timestamp()
+            return float(s)
         except Exception:
-            try:
-                return float(s)
-            except Exception:
-                return float("-inf")
+            return float("-inf")
 
-    latest_msg: dict | None = None
-    latest_ts: float = float("-inf")
-    for msg in messages:
-        try:
-            is_buyer = int(msg.get("buyer", 0)) == 1
-            is_deleted = int(msg.get("deleted", 0)) == 1
-        except Exception:
-            continue
-        if not is_buyer or is_deleted:
-            continue
-        ts = _to_ts(msg.get("date_written") or msg.get("created_at") or None)
-        if ts > latest_ts:
-            latest_ts = ts
-            latest_msg = msg
-    return latest_msg
+
+def _select_last_unread_buyer_message(messages: list[dict]) -> dict | None:
+    # Выбираем САМУЮ ПОСЛЕДНЮЮ реплику покупателя по дате (а не по порядку массива)
+    candidates = (m for m in messages if m.get("buyer") == 1 and not m.get("deleted"))
+    return max(candidates, key=lambda m: _to_ts(m.get("date_written") or m.get("created_at")), default=None)
+
+
+def _msg_id(msg: dict) -> int | None:
+    try:
+        return int(msg.get("id"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def _cached(key: str, ttl: float, fn):
+    """Возвращает результат fn() не старше ttl секунд; одновременные вызовы ждут один запрос."""
+    hit = _RESULT_CACHE.get(key)
+    if hit is not None and time.monotonic() - hit[0] < ttl:
+        return hit[1]
+    lock = _RESULT_LOCKS.setdefault(key, asyncio.Lock())
+    async with lock:
+        hit = _RESULT_CACHE.get(key)
+        if hit is not None and time.monotonic() - hit[0] < ttl:
+            return hit[1]
+        value = await fn()
+        _RESULT_CACHE[key] = (time.monotonic(), value)
+        return value
 
 
-def get_unread():
+async def get_unread():
     """Возвращает список словарей {chat_item, last_message} по непрочитанным чатам (только по /chats)."""
+    return await _cached("unread", UNREAD_CACHE_TTL, _fetch_unread)
+
+
+async def get_recent_orders():
+    """Возвращает только оплаченные заказы по официальному API"""
+    return await _cached("orders", ORDERS_CACHE_TTL, _fetch_recent_orders)
+
+
+async def _fetch_unread():
     # Просим сервер сразу отдать только новые чаты
-    chats = api_list_chats(filter_new=1, page=1, pagesize=20)
-    result = []
+    chats = await api_list_chats(filter_new=1, page=1, pagesize=20)
+    # id_i приводим заранее: диалог с битым id пропускаем, а не роняем весь gather
+    valid = []
     for chat in chats:
-        chat_id = chat.get("id_i")
-        # Тянем сообщения диалога и ищем последнее непрочитанное от покупателя
-        msgs = []
         try:
-            # сначала пробуем получить 1 последний элемент — если API отдаёт в порядке "последний первым"
-            msgs = api_list_messages(conversation_id=int(chat_id), count=1)
-        except Exception:
-            msgs = []
-        # если пришло не то (нет покупателя) — добираем пачку и выбираем по времени
-        if not msgs or not _select_last_unread_buyer_message(msgs):
-            try:
-                msgs = api_list_messages(conversation_id=int(chat_id), count=100)
-            except Exception:
-                msgs = []
-        last_buyer_msg = _select_last_unread_buyer_message(msgs) or (msgs[0] if msgs else None)
-        result.append({"chat": chat, "message": last_buyer_msg})
+            valid.append((int(chat.get("id_i")), chat))
+        except (TypeError, ValueError):
+            logger.warning("Chat with invalid id_i skipped: %r", chat.get("id_i"))
+
+    async def _fetch(chat_id: int, chat: dict) -> dict:
+        etag = (chat.get("last_message"), chat.get("cnt_new"))
+        cached_etag, newest_id, cached_msg = _CHAT_CURSORS.get(chat_id, (None, None, None))
+        # В диалоге ничего не изменилось с прошлого опроса — отдаём запомненную реплику без запроса
+        if cached_etag == etag and etag[0]:
+            return {"chat": chat, "message": cached_msg}
+        # Одним запросом тянем пачку сообщений (только новее курсора) и выбираем последнее от покупателя
+        try:
+            msgs = await api_list_messages(conversation_id=chat_id, count=100, newer=newest_id)
+        except Exception as e:
+            # etag не запоминаем, чтобы в следующий раз повторить запрос
+            logger.warning("Messages fetch failed for chat %s: %s", chat_id, e)
+            return {"chat": chat, "message": cached_msg}
+        last_buyer_msg = _select_last_unread_buyer_message(msgs) or cached_msg or (msgs[0] if msgs else None)
+        newest_id = max((i for i in map(_msg_id, msgs) if i is not None), default=newest_id)
+        _CHAT_CURSORS[chat_id] = (etag, newest_id, last_buyer_msg)
+        return {"chat": chat, "message": last_buyer_msg}
+
+    # Диалоги запрашиваем параллельно: время проверки ≈ самый медленный запрос, а не их сумма
+    result = list(await asyncio.gather(*(_fetch(chat_id, chat) for chat_id, chat in valid)))
+    # Прочитанные диалоги выпадают из выдачи — их курсоры больше не нужны
+    active = {chat_id for chat_id, _ in valid}
+    for chat_id in list(_CHAT_CURSORS):
+        if chat_id not in active:
+            del _CHAT_CURSORS[chat_id]
     return result
 
 
-def get_recent_orders():
-    """Возвращает только оплаченные заказы по официальному API"""
-    sales = api_last_sales(top=4)
+async def _fetch_recent_orders():
+    # У seller-last-sales нет фильтра по статусу оплаты, поэтому фильтруем на нашей стороне
+    # по date_pay из /purchase/info. Оплаченные счета там кэшируются бессрочно,
+    # так что повторная проверка уже известных продаж запросов не делает.
+    sales = [s for s in await api_last_sales(top=4) if s.get("invoice_id") is not None]
+    # Детали по всем продажам тянем параллельно
+    infos = await asyncio.gather(*(api_purchase_info(int(s["invoice_id"])) for s in sales))
     paid = []
-    for sale in sales:
+    for sale, info in zip(sales, infos):
         invoice_id = sale.get("invoice_id")
-        if invoice_id is None:
-            continue
-        info = api_purchase_info(int(invoice_id))
         # Признаком оплаты считаем наличие даты оплаты
         is_paid = bool(info.get("date_pay"))
         if not is_paid:
@@ -272,6 +585,38 @@ def get_recent_orders():
         })
     return paid
 
+# Шаблоны уведомлений собираются один раз; в формат подставляются уже подготовленные поля
+_ALERT_TMPL = (
+    "💬 Новое сообщение от <b>{email}</b>\n"
+    "🗂️ Диалог ID #{conversation_id} — <i>{product_label}</i>\n"
+    "🕒 {dt}\n"
+    "💭 <code>{text}</code>"
+)
+_ORDER_TMPL = (
+    "🧾 Новый заказ №<b>{number}</b>\n"
+    "📦 Товар: <i>{title}</i>\n"
+    "📧 Покупатель: <code>{email}</code>\n"
+    "💰 Сумма: <b>{amount}</b>\n"
+    "📌 Статус: <b>{status}</b>\n"
+    "🕒 {created_at}"
+)
+
+def _escape_capped(text: str, limit: int = ALERT_TEXT_LIMIT) -> str:
+    """html.escape с обрезкой до limit символов результата. Режем исходный текст по символам,
+    а не экранированный, чтобы не разрезать сущность вроде &amp; пополам."""
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    parts = []
+    size = 0
+    for ch in text:
+        piece = html.escape(ch)
+        if size + len(piece) > limit - 1:
+            break
+        parts.append(piece)
+        size += len(piece)
+    return "".join(parts) + "…"
+
 def format_alert(chat_and_msg: dict):
     """Форматирует сообщение для отправки. Если нет текста последнего сообщения,
     строим уведомление по cnt_new/last_message из /chats."""
@@ -281,14 +626,17 @@ def format_alert(chat_and_msg: dict):
     conversation_id = chat.get("id_i") or "—"
     product_id = chat.get("product")
     product_label = f"product #{product_id}" if product_id is not None else "—"
-    text = (msg.get("message") if isinstance(msg, dict) else None) or f"Новых сообщений: {chat.get('cnt_new') or '—'}"
-    dt = (msg.get("date_written") if isinstance(msg, dict) else None) or (chat.get("last_message") or "—")
-    return (
-        f"💬 Новое сообщение от <b>{email}</b>\n"
-        f"🗂️ Диалог ID #{conversation_id} — <i>{product_label}</i>\n"
-        f"🕒 {dt}\n"
-        f"💭 <code>{text}</code>"
-    )
+    text = msg.get("message") or f"Новых сообщений: {chat.get('cnt_new') or '—'}"
+    dt = msg.get("date_written") or chat.get("last_message") or "—"
+    # Текст и email приходят от покупателя — экранируем, иначе HTML-разметка Telegram ломается
+    return _ALERT_TMPL.format_map({
+        "email": html.escape(str(email)),
+        "conversation_id": conversation_id,
+        "product_label": product_label,
+        "dt": dt,
+        # Длинное сообщение покупателя иначе не влезло бы в одно сообщение Telegram даже отдельно
+        "text": _escape_capped(str(text)),
+    })
 
 def format_order_alert(order):
     title = order.get("offer_title", "—")
@@ -297,14 +645,26 @@ def format_order_alert(order):
     status = order.get("status", "—")
     created_at = order.get("created_at", "—")
     number = order.get("number") or order.get("id", "—")
-    return (
-        f"🧾 Новый заказ №<b>{number}</b>\n"
-        f"📦 Товар: <i>{title}</i>\n"
-        f"📧 Покупатель: <code>{email}</code>\n"
-        f"💰 Сумма: <b>{amount}</b>\n"
-        f"📌 Статус: <b>{status}</b>\n"
-        f"🕒 {created_at}"
-    )
+    return _ORDER_TMPL.format_map({
+        "number": number,
+        "title": html.escape(str(title)),
+        "email": html.escape(str(email)),
+        "amount": amount,
+        "status": status,
+        "created_at": created_at,
+    })
+
+def _chunk_messages(alerts: list[str], limit: int = TG_MESSAGE_LIMIT):
+    """Склеивает уведомления через пустую строку в сообщения не длиннее limit символов."""
+    buf = ""
+    for alert in alerts:
+        if buf and len(buf) + len(alert) + 2 > limit:
+            yield buf
+            buf = alert
+        else:
+            buf = f"{buf}\n\n{alert}" if buf else alert
+    if buf:
+        yield buf
 
 # === Телеграм команды и логика ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -319,204 +679,261 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Инициализируем хранилище просмотренных сообщений для авто-оповещений
     chat_id = update.effective_chat.id
     seen_map = context.application.bot_data.setdefault("seen_keys", {})
-    seen_map.setdefault(chat_id, set())
+    seen_map.setdefault(chat_id, _LRUSet())
     orders_seen_map = context.application.bot_data.setdefault("seen_orders", {})
-    orders_seen_map.setdefault(chat_id, set())
+    orders_seen_map.setdefault(chat_id, _LRUSet())
+    # Подписываем чат на общую рассылку: инбокс продавца один на всех,
+    # общие опросы запускаются один раз при старте бота (_start_global_pollers)
+    subscribers = context.application.bot_data.setdefault("subscribers", set())
+    if chat_id not in subscribers:
+        subscribers.add(chat_id)
+        await _save_state(context.application)
 
-    # Настраиваем авто-проверку каждую минуту
-    job_queue = getattr(context, "job_queue", None)
+    # сразу делаем первую проверку для нового чата, не дожидаясь общего опроса
+    # (ошибки _auto_check_once логирует сам)
+    await _auto_check_once(context.application, [chat_id])
+
+def _start_global_pollers(app: Application):
+    """Один общий опрос сообщений и заказов на всех подписчиков, сколько бы их ни было."""
+    if app.bot_data.get("global_jobs_started"):
+        return
+    app.bot_data["global_jobs_started"] = True
+    job_queue = app.job_queue
     if job_queue is not None:
-        job_name = f"auto_check_{chat_id}"
-        for job in job_queue.get_jobs_by_name(job_name):
-            job.schedule_removal()
-        job_queue.run_repeating(
-            auto_check,
-            interval=60,
-            first=5,
-            chat_id=chat_id,
-            name=job_name,
-        )
-        # сразу делаем первую проверку, не дожидаясь 5 секунд
-        try:
-            await _auto_check_once(context.application, chat_id)
-        except Exception:
-            pass
-        # Планируем проверку заказов каждые x минут
-        orders_job_name = f"auto_orders_{chat_id}"
-        for job in job_queue.get_jobs_by_name(orders_job_name):
-            job.schedule_removal()
-        job_queue.run_repeating(
-            auto_orders_check,
-            interval=60,
-            first=10,
-            chat_id=chat_id,
-            name=orders_job_name,
-        )
+        job_queue.run_repeating(global_poll, interval=60, first=5, name=GLOBAL_POLL_JOB)
     else:
-        # Фолбэк без JobQueue: запускаем фоновую задачу
-        task_map = context.application.bot_data.setdefault("bg_tasks", {})
-        # первый прогон сразу
-        try:
-            await _auto_check_once(context.application, chat_id)
-        except Exception:
-            pass
-        t1 = task_map.get((chat_id, "msgs"))
-        if t1 is None or t1.done():
-            t1 = asyncio.create_task(_auto_check_loop(context.application, chat_id, 60))
-            task_map[(chat_id, "msgs")] = t1
-        t2 = task_map.get((chat_id, "orders"))
-        if t2 is None or t2.done():
-            t2 = asyncio.create_task(_auto_orders_loop(context.application, chat_id, 300))
-            task_map[(chat_id, "orders")] = t2
+        # Фолбэк без JobQueue: фоновая задача
+        task_map = app.bot_data.setdefault("bg_tasks", {})
+        app.bot_data["poll_stop"] = asyncio.Event()
+        task_map["poll"] = asyncio.create_task(_poll_loop(app, 60))
 
 async def manual_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Проверяю новые сообщения...")
     try:
-        unread = get_unread()
-        messages = []
-        for chat in unread:
-            alert = format_alert(chat)
-            if alert:
-                messages.append(alert)
+        unread = await get_unread()
+        messages = [format_alert(chat) for chat in unread]
         if messages:
-            await update.message.reply_text("\n\n".join(messages), parse_mode="HTML")
+            for chunk in _chunk_messages(messages):
+                await update.message.reply_text(chunk, parse_mode="HTML")
         else:
             await update.message.reply_text("✅ Новых сообщений нет.")
     except Exception as e:
+        logger.exception("Manual check error for %s", update.effective_chat.id)
         await update.message.reply_text(f"⚠️ Ошибка: {e}")
 
 async def manual_check_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Проверяю новые заказы...")
     chat_id = update.effective_chat.id
     try:
-        orders = get_recent_orders()
+        orders = await get_recent_orders()
         if not orders:
             await update.message.reply_text("✅ Новых заказов нет.")
             return
-        orders_seen_map = context.application.bot_data.setdefault("seen_orders", {})
-        seen_set = orders_seen_map.setdefault(chat_id, set())
-
         alerts = []
         for order in orders:
             oid = order.get("id") or order.get("number")
-            if oid in seen_set:
-                continue
-            seen_set.add(oid)
-            alerts.append(format_order_alert(order))
+            if _mark_seen(context.application, "orders", chat_id, oid):
+                alerts.append(format_order_alert(order))
 
         if alerts:
-            await update.message.reply_text("\n\n".join(alerts), parse_mode="HTML")
+            await _save_state(context.application)
+            for chunk in _chunk_messages(alerts):
+                await update.message.reply_text(chunk, parse_mode="HTML")
         else:
             await update.message.reply_text("✅ Новых заказов нет.")
     except Exception as e:
+        logger.exception("Manual orders check error for %s", chat_id)
         await update.message.reply_text(f"⚠️ Ошибка: {e}")
 
-async def _auto_check_once(app: Application, chat_id: int):
+async def _broadcast(app: Application, outgoing: dict[int, list[str]]):
+    """Параллельно рассылает {chat_id: уведомления}; медленный чат не задерживает остальных.
+    Уведомления склеиваются в сообщения до TG_MESSAGE_LIMIT символов.
+    Чаты, где бот заблокирован или которые удалены, снимаются с подписки."""
+    async def _send(chat_id: int):
+        # внутри одного чата части уходят по порядку
+        for chunk in _chunk_messages(outgoing[chat_id]):
+            async with _SEND_SEMAPHORE:
+                await app.bot.send_message(chat_id=chat_id, text=chunk, parse_mode="HTML")
+
+    chat_ids = list(outgoing)
+    results = await asyncio.gather(*(_send(chat_id) for chat_id in chat_ids), return_exceptions=True)
+    subscribers = app.bot_data.setdefault("subscribers", set())
+    for chat_id, result in zip(chat_ids, results):
+        if not isinstance(result, Exception):
+            continue
+        if isinstance(result, Forbidden) or (isinstance(result, BadRequest) and "chat not found" in str(result).lower()):
+            subscribers.discard(chat_id)
+            logger.warning("Chat %s is unavailable, unsubscribed: %s", chat_id, result)
+        else:
+            logger.warning("Send error for %s: %s", chat_id, result)
+
+async def _queue_alerts(app: Application, outgoing: dict[int, list[str]]):
+    """Ставит уведомления в очередь диспетчера; без диспетчера отправляет сразу."""
+    dispatch_queue = app.bot_data.get("dispatch_queue")
+    if dispatch_queue is None:
+        await _broadcast(app, outgoing)
+        return
+    for chat_id, alerts in outgoing.items():
+        for alert in alerts:
+            dispatch_queue.put_nowait((chat_id, alert))
+
+async def _flush_alerts(app: Application, batch: list[tuple[int, str]]):
+    outgoing: dict[int, list[str]] = {}
+    for chat_id, alert in batch:
+        outgoing.setdefault(chat_id, []).append(alert)
     try:
-        unread = get_unread()
-        alerts = []
-        seen_map = app.bot_data.setdefault("seen_keys", {})
-        seen_set = seen_map.setdefault(chat_id, set())
+        await _broadcast(app, outgoing)
+    except Exception:
+        logger.exception("Dispatch error")
+
+async def _dispatcher(app: Application, dispatch_queue: asyncio.Queue):
+    """Копит уведомления, пока они идут подряд (пауза < DISPATCH_GAP, окно до DISPATCH_WINDOW),
+    и отправляет их пачкой: сообщения и заказы одного опроса приходят одним сообщением."""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await dispatch_queue.get()
+        if item is None:
+            return
+        batch = [item]
+        deadline = loop.time() + DISPATCH_WINDOW
+        while len(batch) < DISPATCH_MAX_ITEMS:
+            timeout = min(DISPATCH_GAP, deadline - loop.time())
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(dispatch_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                # сигнал остановки: досылаем накопленное и выходим
+                stopping = True
+                break
+            batch.append(item)
+        await _flush_alerts(app, batch)
+
+def _start_dispatcher(app: Application):
+    dispatch_queue: asyncio.Queue = asyncio.Queue()
+    app.bot_data["dispatch_queue"] = dispatch_queue
+    app.bot_data.setdefault("bg_tasks", {})["dispatcher"] = asyncio.create_task(_dispatcher(app, dispatch_queue))
+
+async def _stop_dispatcher(app: Application):
+    # None в очереди — сигнал остановки: диспетчер досылает всё, что было поставлено до него
+    task = app.bot_data.get("bg_tasks", {}).pop("dispatcher", None)
+    dispatch_queue = app.bot_data.pop("dispatch_queue", None)
+    if task is None or dispatch_queue is None:
+        return
+    dispatch_queue.put_nowait(None)
+    await task
 
+async def _deliver_new(app: Application, kind: str, candidates: list[tuple], chat_ids: list[int]):
+    """Рассылает каждому чату только те (ключ, уведомление), которых он ещё не видел:
+    дедупликация своя у каждого подписчика, запрос к API — общий."""
+    outgoing = {}
+    for chat_id in chat_ids:
+        alerts = [alert for key, alert in candidates if _mark_seen(app, kind, chat_id, key)]
+        if alerts:
+            outgoing[chat_id] = alerts
+    if outgoing:
+        await _save_state(app)
+        await _queue_alerts(app, outgoing)
+
+async def _auto_check_once(app: Application, chat_ids: list[int] | None = None):
+    """Один запрос к API на всех подписчиков; по умолчанию рассылает всем из bot_data["subscribers"]."""
+    chat_ids = list(app.bot_data.get("subscribers", ())) if chat_ids is None else chat_ids
+    if not chat_ids:
+        return
+    try:
+        unread = await get_unread()
+        candidates = []
         for chat in unread:
+            # Сервер отдаёт только диалоги с непрочитанным (filter_new=1), а реплику покупателя
+            # уже выбрал _select_last_unread_buyer_message — повторно ничего не фильтруем
             alert = format_alert(chat)
-            if not alert:
-                continue
             chat_item = chat.get("chat", {})
-            msg = chat.get("message", {})
+            msg = chat.get("message") or {}
             conversation_id = chat_item.get("id_i")
             msg_id = (
-                (msg.get("id") if isinstance(msg, dict) else None)
-                or (msg.get("date_written") if isinstance(msg, dict) else None)
+                msg.get("id")
+                or msg.get("date_written")
                 or chat_item.get("last_message")
                 or chat_item.get("cnt_new")
             )
-            key = f"{conversation_id}:{msg_id}"
-            if key in seen_set:
-                continue
-            seen_set.add(key)
-            alerts.append(alert)
-
-        if alerts:
-            await app.bot.send_message(chat_id=chat_id, text="\n\n".join(alerts), parse_mode="HTML")
-    except Exception as e:
-        print(f"Auto-check error for {chat_id}: {e}")
-
-async def auto_check(context: ContextTypes.DEFAULT_TYPE):
-    # Callback для JobQueue
-    chat_id = context.job.chat_id
-    await _auto_check_once(context.application, chat_id)
-
-async def _auto_check_loop(app: Application, chat_id: int, interval_seconds: int):
-    # Фолбэк-цикл, если JobQueue недоступен
-    await asyncio.sleep(5)
-    while True:
-        await _auto_check_once(app, chat_id)
-        await asyncio.sleep(interval_seconds)
+            candidates.append(((conversation_id, msg_id), alert))
+        await _deliver_new(app, "keys", candidates, chat_ids)
+    except Exception:
+        logger.exception("Auto-check error")
 
-async def _auto_orders_once(app: Application, chat_id: int):
+async def _auto_orders_once(app: Application, chat_ids: list[int] | None = None):
+    """Как _auto_check_once, но для заказов: один запрос, дедупликация по seen_orders каждого чата."""
+    chat_ids = list(app.bot_data.get("subscribers", ())) if chat_ids is None else chat_ids
+    if not chat_ids:
+        return
     try:
-        orders = get_recent_orders()
-        if not orders:
-            return
-        orders_seen_map = app.bot_data.setdefault("seen_orders", {})
-        seen_set = orders_seen_map.setdefault(chat_id, set())
-        alerts = []
-        for order in orders:
-            oid = order.get("id") or order.get("number")
-            if oid in seen_set:
-                continue
-            seen_set.add(oid)
-            alerts.append(format_order_alert(order))
-        if alerts:
-            await app.bot.send_message(chat_id=chat_id, text="\n\n".join(alerts), parse_mode="HTML")
-    except Exception as e:
-        print(f"Auto-orders error for {chat_id}: {e}")
+        orders = await get_recent_orders()
+        # уведомление форматируем один раз на заказ, а не на каждого подписчика
+        candidates = [(o.get("id") or o.get("number"), format_order_alert(o)) for o in orders]
+        await _deliver_new(app, "orders", candidates, chat_ids)
+    except Exception:
+        logger.exception("Auto-orders error")
 
-async def auto_orders_check(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.job.chat_id
-    await _auto_orders_once(context.application, chat_id)
+async def _poll_once(app: Application):
+    # Сообщения и заказы проверяем одновременно: ожидания ответов API перекрываются.
+    # Каждая проверка сама логирует свои ошибки и не мешает другой
+    await asyncio.gather(_auto_check_once(app), _auto_orders_once(app), return_exceptions=True)
 
-async def _auto_orders_loop(app: Application, chat_id: int, interval_seconds: int):
-    await asyncio.sleep(5)
+async def global_poll(context: ContextTypes.DEFAULT_TYPE):
+    # Callback для JobQueue: общий опрос на всех подписчиков
+    await _poll_once(context.application)
+
+async def _poll_loop(app: Application, interval_seconds: int):
+    # Фолбэк-цикл, если JobQueue недоступен. Останавливается по poll_stop между опросами,
+    # а не отменой: иначе опрос мог бы прерваться между _mark_seen и постановкой в очередь
+    stop = app.bot_data["poll_stop"]
+    delay = 5
     while True:
-        await _auto_orders_once(app, chat_id)
-        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+            return
+        except asyncio.TimeoutError:
+            pass
+        await _poll_once(app)
+        delay = interval_seconds
 
 async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Мини-диагностика: apilogin + базовые GET и общий вердикт."""
     env_seller = SELLER_ID or "—"
 
-    def probe(url: str, params: dict, ru: bool = False) -> int:
+    async def probe(url: str, params: dict, ru: bool = False) -> int:
         try:
             params = dict(params)
-            _ensure_api_token()
+            await _ensure_api_token()
             if API_TOKEN and "token" not in params:
                 params["token"] = API_TOKEN
             headers = _auth_headers(locale_ru=ru)
-            r = requests.get(url, params=params, headers=headers, timeout=60)
+            r = await CLIENT.get(url, params=params, headers=headers, timeout=60)
             return r.status_code
         except Exception:
             return 0
 
     # apilogin напрямую
-    def probe_apilogin() -> int:
+    async def probe_apilogin() -> int:
         try:
             ts = str(int(time.time()))
-            sign = _sha256_hex(f"{API_KEY}{ts}") if API_KEY else ""
-            r = requests.post(
+            sign = _sha256_hex(ts) if API_KEY else ""
+            r = await CLIENT.post(
                 API_LOGIN_URL,
-                json={"seller_id": int(SELLER_ID) if SELLER_ID else 0, "timestamp": ts, "sign": sign},
-                headers=_auth_headers(locale_ru=True, with_bearer=False),
+                content=orjson.dumps({"seller_id": int(SELLER_ID) if SELLER_ID else 0, "timestamp": ts, "sign": sign}),
+                headers=_auth_headers(locale_ru=True, with_bearer=False) | HEADERS_JSON_BODY,
                 timeout=60,
             )
             return r.status_code
         except Exception:
             return 0
 
-    login_status = probe_apilogin()
-    chats_status = probe(DEBATES_CHATS_URL, {"filter_new": 1, "page": 1, "pagesize": 1})
-    sales_status = probe(LAST_SALES_URL, {"seller_id": env_seller, "top": 1}, ru=True) if env_seller != "—" else 0
+    login_status = await probe_apilogin()
+    chats_status = await probe(DEBATES_CHATS_URL, {"filter_new": 1, "page": 1, "pagesize": 1})
+    sales_status = await probe(LAST_SALES_URL, {"seller_id": env_seller, "top": 1}, ru=True) if env_seller != "—" else 0
 
     ok = login_status == 200 and chats_status == 200 and sales_status == 200
     verdict = "✅ API настроен верно" if ok else "❌ API настроен неверно"
@@ -530,13 +947,62 @@ async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("\n".join(lines))
 
+def _setup_logging():
+    global _LOG_LISTENER
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    _LOG_LISTENER = QueueListener(log_queue, stream)
+    _LOG_LISTENER.start()
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def _stop_logging():
+    # stop() дописывает всё, что осталось в очереди
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+
+
+async def _on_startup(app: Application):
+    global CLIENT
+    CLIENT = _create_http_client()
+    _start_dispatcher(app)
+    _start_global_pollers(app)
+
+
+async def _on_stop(app: Application):
+    # post_stop: JobQueue уже остановлен, но бот ещё инициализирован — досылаем очередь сейчас.
+    # В post_shutdown bot.shutdown() уже отработал, и отправка падала бы, а ключи уже помечены
+    stop = app.bot_data.get("poll_stop")
+    poll_task = app.bot_data.get("bg_tasks", {}).pop("poll", None)
+    if stop is not None and poll_task is not None:
+        stop.set()
+        await poll_task
+    await _stop_dispatcher(app)
+
+
+async def _on_shutdown(app: Application):
+    # Сохраняем состояние и закрываем пул соединений GGSEL при остановке бота
+    await _save_state(app)
+    _close_state_db()
+    if CLIENT is not None:
+        await CLIENT.aclose()
+    _stop_logging()
+
 # === Запуск бота ===
 def main():
-    print("🚀 Бот запускается...")
+    _setup_logging()
+    logger.info("🚀 Бот запускается...")
     if not BOT_TOKEN or ":" not in BOT_TOKEN or len(BOT_TOKEN) < 30:
-        print("❌ Не найден корректный токен Telegram. Проверь .env:")
-        print("   Требуется переменная TG_BOT_TOKEN=xxxxxxxxx:YYYYYYYYYYYYYYYYYYYYYYYYYYYYYYYY")
-        print("   Текущая рабочая папка:", os.getcwd())
+        logger.error(
+            "❌ Не найден корректный токен Telegram. Проверь .env:\n"
+            "   Требуется переменная TG_BOT_TOKEN=xxxxxxxxx:YYYYYYYYYYYYYYYYYYYYYYYYYYYYYYYY\n"
+            "   Текущая рабочая папка: %s",
+            os.getcwd(),
+        )
+        _stop_logging()
         raise SystemExit(1)
     # Увеличим таймауты Telegram HTTP-клиента, чтобы избежать TimedOut при отправке
     request = HTTPXRequest(
@@ -545,14 +1011,28 @@ def main():
         connect_timeout=15.0,
         pool_timeout=15.0,
     )
-    app = Application.builder().token(BOT_TOKEN).request(request).build()
+    app = Application.builder().token(BOT_TOKEN).request(request).post_init(_on_startup).post_stop(_on_stop).post_shutdown(_on_shutdown).build()
+    app.bot_data.update(_load_state())
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(fr"^{re.escape(BUTTON_TEXT)}$"), manual_check))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^🧾 Проверить заказы$"), manual_check_orders))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^🔍 Диагностика API$"), debug))
+    # Кнопки — точные строки: filters.Text сверяет по множеству, без прогона регулярки на каждый апдейт
+    app.add_handler(MessageHandler(filters.Text({BUTTON_TEXT}), manual_check))
+    app.add_handler(MessageHandler(filters.Text({BUTTON_TEXT_ORDERS}), manual_check_orders))
+    app.add_handler(MessageHandler(filters.Text({BUTTON_TEXT_DEBUG}), debug))
     app.add_handler(CommandHandler("debug", debug))
-    print("✅ Бот запущен. Открой в Telegram и отправь /start")
-    app.run_polling()
+    logger.info("✅ Бот запущен. Открой в Telegram и отправь /start")
+    if WEBHOOK_URL:
+        # Путь вебхука выводим из токена, чтобы не светить сам токен в URL и логах прокси.
+        # Путь виден в тех же логах, поэтому подлинность апдейтов проверяем по secret_token
+        url_path = hashlib.sha256(BOT_TOKEN.encode("utf-8")).hexdigest()[:32]
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=f"{WEBHOOK_URL}/{url_path}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()